@@ -1,101 +1,210 @@
+from dataclasses import dataclass
 import datetime
+import email.utils
+import http.client
 import os
+import re
 from pathlib import Path
+import shlex
 import shutil
 import subprocess
 import json
 import logging
-import tempfile
 import time
-from typing import TypedDict
+from typing import NamedTuple, TypedDict
+import urllib.error
+import urllib.request
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 # Root logger
-logger = logging.getLogger(Path(__file__).name)
+logger = logging.getLogger("owasp-headers")
+LOG_FORMATTER = logging.Formatter(
+    "%(asctime)s [%(levelname)-4.7s] %(filename)s:%(lineno)d  %(message)s"
+)
 
 # Constants
 URL = "https://owasp.org/www-project-secure-headers/ci/headers_remove.json"
-DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+HTTP_CACHE_NAME = ".headers_remove.cache.json"
+HTTP_TIMEOUT = 10
+LOG_POLL_INTERVAL = 0.1
+_LEVEL_NAMES = logging.getLevelNamesMapping()
+_LEVEL_NAMES_KEYS = list(_LEVEL_NAMES)
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}", re.ASCII)
 
+# One opener for the whole run, so every request shares the same handlers and headers
+OPENER = urllib.request.build_opener()
+OPENER.addheaders = [("User-Agent", "traefik-owasp-updater/1.0")]
 
-class Curl:
-    def __init__(self):
-        pass
 
-    def _execute(self, args: list[str]) -> str:
-        cmd_output = subprocess.run(["curl", *args], capture_output=True)
+class _HttpCacheDict(TypedDict):
+    etag: str | None
+    # The timestamp of the local config the etag was saved for
+    last_update_utc: str
+
 
-        logger.debug(f"{cmd_output}")
+def read_http_cache(cache_path: Path) -> _HttpCacheDict | None:
+    if not cache_path.exists():
+        return None
 
-        if cmd_output.returncode != 0:
-            return ""
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        logger.warning(f"Could not read http cache at {cache_path}. Error: {err}")
+        return None
 
-        return cmd_output.stdout.decode()
 
-    def command_exists(self) -> bool:
-        return not self.version().lstrip().startswith("curl")
+def write_http_cache(cache_path: Path, cache: _HttpCacheDict):
+    try:
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+    except OSError as err:
+        logger.warning(f"Could not write http cache at {cache_path}. Error: {err}")
+
+
+class FetchResult(NamedTuple):
+    body: bytes
+    etag: str | None
+
+
+def fetch_if_modified(
+    url: str, since: datetime.datetime | None, cache_path: Path
+) -> FetchResult | None:
+    # Send validators for our local version, so the server can answer with
+    # 304 Not Modified instead of sending the whole body again. The cached
+    # etag is only sent if it was saved for the local config we have now.
+    # Returns None if nothing has changed since our local version
+    headers: dict[str, str] = {}
+    if since is not None:
+        headers["If-Modified-Since"] = email.utils.format_datetime(
+            since.replace(tzinfo=datetime.timezone.utc), usegmt=True
+        )
+        cache = read_http_cache(cache_path)
+        if (
+            cache is not None
+            and cache.get("etag") is not None
+            and cache.get("last_update_utc") == format_date(since)
+        ):
+            headers["If-None-Match"] = cache["etag"]
+
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with OPENER.open(request, timeout=HTTP_TIMEOUT) as response:
+            return FetchResult(response.read(), response.headers.get("ETag"))
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            logger.debug(f"Got 304 Not Modified from {url}")
+            return None
+        raise
 
-    def version(self) -> str:
-        return self._execute(["-V"])
 
-    def get_data(self, url: str, args: list[str] = ["-s", "-f", "-L"]) -> str:
-        return self._execute([url, *args])
+def parse_date(date_str: str) -> datetime.datetime:
+    # Dates are written as "%Y-%m-%d %H:%M:%S", which is ISO 8601 with a space
+    # as separator, so the C implemented fromisoformat can be used over strptime.
+    # fromisoformat accepts a lot more, so only let that exact layout through
+    if DATE_PATTERN.fullmatch(date_str) is None:
+        raise ValueError(f'The date "{date_str}" does not match "%Y-%m-%d %H:%M:%S"')
+    return datetime.datetime.fromisoformat(date_str.replace(" ", "T", 1))
 
 
-class _RemoveHeadersDict(TypedDict):
-    last_update_utc: str | None
-    headers: list[str] | None
+def format_date(date: datetime.datetime) -> str:
+    return date.isoformat(sep=" ", timespec="seconds")
 
 
+@dataclass(slots=True, frozen=True)
 class RemoveHeaders:
-    def __init__(self, data_str: str):
-        data: _RemoveHeadersDict = json.loads(data_str)
-
-        # Validate the date
-        if data["last_update_utc"] is None:
-            raise ValueError('Could not find "last_update_utc"')
-        self._last_update_utc = datetime.datetime.strptime(
-            data["last_update_utc"], DATE_FORMAT
-        )
+    last_update_utc: datetime.datetime
+    headers: tuple[str, ...]
 
-        # Validate the headers
-        if data["headers"] is None:
-            raise ValueError('Could not find "headers"')
-        self._headers = data["headers"]
 
-        self._data = data
+def parse_remove_headers(raw: bytes | str) -> RemoveHeaders:
+    data = _json.loads(raw)
 
-    @property
-    def last_update_utc(self) -> datetime.datetime:
-        return self._last_update_utc
+    # Validate the date
+    last_update_utc = data.get("last_update_utc")
+    if last_update_utc is None:
+        raise ValueError('Could not find "last_update_utc"')
 
-    @property
-    def headers(self) -> list[str]:
-        return self._headers
+    # Validate the headers
+    headers = data.get("headers")
+    if headers is None:
+        raise ValueError('Could not find "headers"')
+
+    return RemoveHeaders(
+        last_update_utc=parse_date(last_update_utc),
+        headers=tuple(headers),
+    )
+
+
+# Waits for a file to be modified, with inotify if it is available
+class LogWatcher:
+    def __init__(self, path: Path):
+        self._inotify = None
+        if inotify_simple is not None:
+            try:
+                self._inotify = inotify_simple.INotify()
+                self._inotify.add_watch(path, inotify_simple.flags.MODIFY)
+            except (OSError, AttributeError) as err:
+                # inotify is only available on Linux
+                logger.debug(f"Could not watch {path} with inotify. Error: {err}")
+                self.close()
+
+    def wait(self, timeout: float):
+        timeout = max(timeout, 0)
+        if self._inotify is None:
+            time.sleep(min(LOG_POLL_INTERVAL, timeout))
+        else:
+            self._inotify.read(timeout=int(timeout * 1000))
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def __enter__(self) -> "LogWatcher":
+        return self
 
+    def __exit__(self, *_):
+        self.close()
 
-def get_date_from_yaml_config(path: Path) -> datetime.datetime:
-    # Default timestamp, if nothing is found
-    last_update_utc = datetime.datetime.fromtimestamp(0)
 
-    # Read yaml
-    with open(path) as f:
-        yaml_lines = f.readlines()
+def get_date_from_yaml_config(path: Path) -> datetime.datetime | None:
+    # None if nothing is found
+    last_update_utc: datetime.datetime | None = None
 
-    # Try to find timestamp
+    # Try to find timestamp. It is always written in the leading comment block,
+    # so stop reading as soon as we leave it
     UPDATE_STRING = "# Updated on: "
-    for line in yaml_lines:
-        if line.startswith(UPDATE_STRING):
-            # Timestamp found, trying to parse date
-            try:
-                last_update_utc = datetime.datetime.strptime(
-                    line.removeprefix(UPDATE_STRING).strip(), DATE_FORMAT
-                )
-            except ValueError:
-                logger.error("Could not parse last update timestamp")
-            else:
-                # Everything went well
+    MAX_HEADER_LINES = 5
+    found = False
+    with path.open("r", buffering=8192, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i > MAX_HEADER_LINES or (
+                line.strip() != "" and not line.startswith("#")
+            ):
                 break
-    else:
+            if line.startswith(UPDATE_STRING):
+                # Timestamp found, trying to parse date
+                try:
+                    last_update_utc = parse_date(
+                        line.removeprefix(UPDATE_STRING).strip()
+                    )
+                except ValueError:
+                    logger.error("Could not parse last update timestamp")
+                else:
+                    # Everything went well
+                    found = True
+                    break
+    if not found:
         logger.error(
             f"Could not find last update timestamp, will generate new from {URL}"
         )
@@ -103,63 +212,120 @@ def get_date_from_yaml_config(path: Path) -> datetime.datetime:
     return last_update_utc
 
 
-def write_yaml_config(path: Path, middleware_name: str, remove_headers: RemoveHeaders):
+def _copy_owner_and_mode(src: Path, dst: Path):
+    shutil.copymode(src, dst)
+    st = src.stat()
+    try:
+        os.chown(dst, st.st_uid, st.st_gid)
+    except PermissionError:
+        # Only root can give files away, keep our own owner
+        pass
+
+
+def _without_comments(yaml: bytes) -> list[bytes]:
+    return [line for line in yaml.splitlines() if not line.startswith(b"#")]
+
+
+def write_yaml_config(
+    path: Path, middleware_name: str, remove_headers: RemoveHeaders
+) -> bool:
     ### As python does not have a yaml parser/writer in std, this will be best effort
+    ### Returns if anything other than the comments changed
 
     # Construct a 2d array where every row is a new indent and each column is
     # on the same indent
     string_2d = [
         [
             f"# DO NOT MODIFY. THIS FILE IS GENERATED FROM {URL}",
-            f"# Updated on: {remove_headers.last_update_utc}",
+            f"# Updated on: {format_date(remove_headers.last_update_utc)}",
             "http:",
         ],
         ["middlewares:"],
         [f"{middleware_name}:"],
         ["headers:"],
         ["customResponseHeaders:"],
-        [*[f'{headers_str}: ""' for headers_str in remove_headers.headers]],
+        # Sorted and deduplicated, so the same headers always give the same file
+        [headers_str + ': ""' for headers_str in sorted(set(remove_headers.headers))],
     ]
 
-    with open(path, "w") as f:
-        indent_size = 2
-        for tabs, strings_with_same_indent in enumerate(string_2d):
-            for string in strings_with_same_indent:
-                f.write(f"{' ' * indent_size * tabs}{string}\n")
+    # Build the whole file in memory and write it in one go
+    indent_size = 2
+    lines: list[str] = []
+    for tabs, strings_with_same_indent in enumerate(string_2d):
+        indent = " " * indent_size * tabs
+        lines.extend(indent + string for string in strings_with_same_indent)
+
+    payload = ("\n".join(lines) + "\n").encode()
+
+    changed = True
+    if path.exists():
+        old_payload = path.read_bytes()
+        if old_payload == payload:
+            return False
+        changed = _without_comments(old_payload) != _without_comments(payload)
+
+    # Write to a temporary file and rename it over the config, so traefik never
+    # sees a partially written file
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            _copy_owner_and_mode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Do not leave the temporary file in the traefik config directory
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return changed
 
 
 def main(config: "Config") -> int:
-    curl = Curl()
-
-    if curl.command_exists():
-        logger.error('Could not find "curl"')
-        return 1
+    http_cache_path = config.config_path.parent / HTTP_CACHE_NAME
 
-    data = curl.get_data(URL)
+    # Get local version
+    last_update_utc: datetime.datetime | None = None
+    if config.config_path.exists():
+        last_update_utc = get_date_from_yaml_config(config.config_path)
 
-    if data == "":
-        logger.error(f"Something went wrong when getting data from url: {URL}")
+    try:
+        fetch_result = fetch_if_modified(URL, last_update_utc, http_cache_path)
+    except (OSError, http.client.HTTPException) as err:
+        logger.error(
+            f"Something went wrong when getting data from url: {URL}. Error: {err}"
+        )
         return 1
 
+    if fetch_result is None:
+        logger.info("We are already up to date. Exiting...")
+        return 0
+
     # Get web version
     try:
-        web_version = RemoveHeaders(data)
+        web_version = parse_remove_headers(fetch_result.body)
     except ValueError as err:
         logger.error(
             f"Something went wrong when validating data received from {URL}. Error: {err}"
         )
         return 1
 
-    # Get local version
-    tmp_dir: tempfile.TemporaryDirectory | None
-    old_file: Path | None
+    backup_path: Path | None
     if config.config_path.exists():
-        tmp_dir = tempfile.TemporaryDirectory()
-        last_update_utc = get_date_from_yaml_config(config.config_path)
-
         # Check if our file is newer or equal to the web version
-        if last_update_utc >= web_version.last_update_utc:
+        if (
+            last_update_utc is not None
+            and last_update_utc >= web_version.last_update_utc
+        ):
             logger.info("We are already up to date. Exiting...")
+            write_http_cache(
+                http_cache_path,
+                {
+                    "etag": fetch_result.etag,
+                    "last_update_utc": format_date(last_update_utc),
+                },
+            )
             return 0
 
         # Our file was not up to date, save and update local headers
@@ -167,11 +333,17 @@ def main(config: "Config") -> int:
 
         # Save old yaml config to be able to go back to if the updated version generates errors
         logger.info("Making backup of current version")
-        shutil.copy2(config.config_path, tmp_dir.name)
-        old_file = Path(tmp_dir.name) / config.config_path.name
+        backup_path = config.config_path.with_name(config.config_path.name + ".bak")
+        backup_path.unlink(missing_ok=True)
+        try:
+            # The config is replaced and not modified in place when updating,
+            # so a hard link keeps the old file without copying it
+            os.link(config.config_path, backup_path)
+        except OSError:
+            shutil.copyfile(config.config_path, backup_path)
+            _copy_owner_and_mode(config.config_path, backup_path)
     else:
-        tmp_dir = None
-        old_file = None
+        backup_path = None
         logger.warning(
             f"Could not find {config.config_path}, generating new file from {URL}"
         )
@@ -180,49 +352,67 @@ def main(config: "Config") -> int:
     try:
         logger.debug(f"Write headers to traefik config at `{config.config_path}`")
         if config.traefik_log is not None:
-            # save timestamp so we know where we need to start the search from
+            # save timestamp and log size so we know where we need to start the search from
             timestamp_before_writing = datetime.datetime.now().astimezone()
+            log_size_before_writing = config.traefik_log.stat().st_size
 
-        write_yaml_config(
+        headers_changed = write_yaml_config(
             config.config_path,
             config.middleware_header,
             web_version,
         )
+        if not headers_changed:
+            logger.info("The headers did not change, skipping traefik restart")
 
-        if config.restart_traefik:
+        if headers_changed and config.restart_traefik:
             logger.info("Restarting Traefik to apply changes")
-            traefik_restart_proc = subprocess.run(config.traefik_restart_cmd.split())
+            traefik_restart_proc = subprocess.run(config.traefik_restart_argv)
             traefik_restart_proc.check_returncode()
             logger.debug("traefik restart with 0 as exit code")
 
         # If the change generates errors we go back to the old version
-        if config.traefik_log is not None:
+        if headers_changed and config.traefik_log is not None:
             logger.info(
                 f"Reading traefik logs for {config.wait_for_errors_time} seconds at: {config.traefik_log}"
             )
             end_time = time.time() + config.wait_for_errors_time
-            with open(config.traefik_log) as f:
-                log_msg = ""
+            with open(config.traefik_log) as f, LogWatcher(
+                config.traefik_log
+            ) as log_watcher:
+                # Skip everything that was logged before the update. If the log
+                # has shrunk it was rotated, so we read it from the start
+                if log_size_before_writing <= os.fstat(f.fileno()).st_size:
+                    f.seek(log_size_before_writing)
+                # State of the log message being read. A message can span
+                # multiple lines, so the state is updated for every line
+                msg_timestamp: datetime.datetime | None = None
+                msg_has_err = False
+                msg_has_needle = False
                 while time.time() <= end_time or config.wait_for_errors_time == 0:
                     for line in f:
                         try:
                             timestamp = datetime.datetime.fromisoformat(
                                 line.split()[0].strip()
                             )
-                            log_msg = line
                         except Exception:
                             # If we get here we know that we are still on the same log message
-                            # So we append it do the log_msg string
-                            log_msg += f"\n{line}"
-                            continue
+                            pass
+                        else:
+                            # A new log message starts
+                            msg_timestamp = timestamp
+                            msg_has_err = False
+                            msg_has_needle = False
+                        msg_has_err = msg_has_err or "ERR" in line
+                        msg_has_needle = (
+                            msg_has_needle
+                            or config.log_needle_pattern.search(line) is not None
+                        )
                         if (
-                            timestamp_before_writing
-                            <= timestamp  # Timestamp is after writing the file
-                            and "ERR" in log_msg  # There is an error
-                            and (
-                                config.middleware_header in log_msg
-                                or config.config_path.name in log_msg
-                            )  # The error contain our header or file
+                            msg_timestamp is not None
+                            and timestamp_before_writing
+                            <= msg_timestamp  # Timestamp is after writing the file
+                            and msg_has_err  # There is an error
+                            and msg_has_needle  # The error contain our header or file
                         ):
                             raise RuntimeError(
                                 f"Found errors in {config.traefik_log} that could be caused by the update"
@@ -230,6 +420,8 @@ def main(config: "Config") -> int:
                     if config.wait_for_errors_time == 0:
                         # the wait time is zero, so we will just run through lines ones.
                         break
+                    # Wait for traefik to write more lines before reading again
+                    log_watcher.wait(end_time - time.time())
             logger.info(
                 f"Found no errors in log, related to {config.middleware_header} or {config.config_path}"
             )
@@ -238,38 +430,43 @@ def main(config: "Config") -> int:
         logger.error(
             f"Something went wrong when updating, reverting changes. Error: {err}"
         )
-        # Remove the newly written yaml config
-        if config.config_path.exists():
-            os.remove(config.config_path)
-
-        # Move back the old file
-        if tmp_dir is not None and old_file is not None and old_file.exists():
-            shutil.copy2(old_file, config.config_path)
+        if backup_path is not None and backup_path.exists():
+            # Move back the old file over the newly written yaml config
+            os.replace(backup_path, config.config_path)
             if config.restart_traefik:
                 logger.info("Restarting Traefik to revert changes")
                 traefik_restart_proc = subprocess.run(
-                    config.traefik_restart_cmd.split()
+                    config.traefik_restart_argv, check=False
                 )
+        elif config.config_path.exists():
+            # There was no old file, remove the newly written yaml config
+            os.remove(config.config_path)
+    else:
+        # Our config now matches the web version, so it is safe to let the
+        # server answer 304 Not Modified until the web version changes
+        write_http_cache(
+            http_cache_path,
+            {
+                "etag": fetch_result.etag,
+                "last_update_utc": format_date(web_version.last_update_utc),
+            },
+        )
 
-    if tmp_dir is not None:
-        tmp_dir.cleanup()
+    if backup_path is not None:
+        backup_path.unlink(missing_ok=True)
 
     logger.info("Update was successful")
     return 0
 
 
 def setup_logging(config: "Config"):
-    log_formatter = logging.Formatter(
-        "%(asctime)s [%(levelname)-4.7s] %(filename)s:%(lineno)d  %(message)s"
-    )
-
     if config.log_path is not None:
         fileHandler = logging.FileHandler(config.log_path)
-        fileHandler.setFormatter(log_formatter)
+        fileHandler.setFormatter(LOG_FORMATTER)
         logger.addHandler(fileHandler)
 
     consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(log_formatter)
+    consoleHandler.setFormatter(LOG_FORMATTER)
     logger.addHandler(consoleHandler)
     logger.setLevel(config.log_level)
 
@@ -309,17 +506,23 @@ class Config:
         else:
             self._middleware_header = middleware_header
 
+        # Matches log lines that mention our header or file
+        self._log_needle_pattern = re.compile(
+            f"{re.escape(middleware_header)}|{re.escape(tmp_config_path.name)}"
+        )
+
         if traefik_restart_cmd.strip() == "":
             raise ValueError(
                 f"The given restart command is empty. Command: {traefik_restart_cmd}"
             )
         else:
             self._traefik_restart_cmd = traefik_restart_cmd
+            self._traefik_restart_argv = shlex.split(traefik_restart_cmd)
 
-        tmp_log_level = logging.getLevelNamesMapping().get(log_level.upper())
+        tmp_log_level = _LEVEL_NAMES.get(log_level.upper())
         if tmp_log_level is None:
             raise ValueError(
-                f'The given log level "{log_level}" is not a valid debug level. Valid levels: {list(logging.getLevelNamesMapping().keys())}'
+                f'The given log level "{log_level}" is not a valid debug level. Valid levels: {_LEVEL_NAMES_KEYS}'
             )
         self._log_level = tmp_log_level
 
@@ -361,6 +564,10 @@ class Config:
     def middleware_header(self) -> str:
         return self._middleware_header
 
+    @property
+    def log_needle_pattern(self) -> re.Pattern[str]:
+        return self._log_needle_pattern
+
     @property
     def traefik_log(self) -> Path | None:
         return self._traefik_log
@@ -373,12 +580,18 @@ class Config:
     def traefik_restart_cmd(self) -> str:
         return self._traefik_restart_cmd
 
+    @property
+    def traefik_restart_argv(self) -> list[str]:
+        return self._traefik_restart_argv
+
     @property
     def wait_for_errors_time(self) -> int:
         return self._wait_for_errors_time
 
 
 def cli() -> Config:
+    import argparse
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -441,8 +654,6 @@ def cli() -> Config:
 
 
 if __name__ == "__main__":
-    import argparse
-
     # Handle cli
     config = cli()
 